@@ -1,18 +1,32 @@
 import numpy as np
 import scipy.optimize
 
-__all__ = ['create_optimizer']
+try:
+    import cupy
+except ImportError:
+    cupy = None
 
+__all__ = ['create_optimizer', 'create_linear_volume_calculator']
 
-def to_array(item):
-    if isinstance(item, (tuple, list)):
-        return np.array(item)
-    elif isinstance(item, np.ndarray):
-        return item
+
+def to_array(item, dtype=None, xp=None):
+    if dtype is None:
+        dtype = item.dtype if is_floating_array(item) else np.float64
+    xp = get_array_module(item) if xp is None else xp
+    return xp.asarray(item, dtype=dtype)
+
+
+def is_floating_array(item):
+    return hasattr(item, 'dtype') and np.issubdtype(item.dtype, np.floating)
+
+
+def get_array_module(item):
+    # arrays already living on a GPU stay there, all the other numpy calls dispatch to cupy by themselves
+    return np if cupy is None else cupy.get_array_module(item)
 
 
-_big_number = 9e99
 _small_number = 1e-6
+_block_size = 2 ** 16
 
 
 def none_or_call(indicator, _callable, *args, **kwargs):
@@ -20,9 +34,93 @@ def none_or_call(indicator, _callable, *args, **kwargs):
         return _callable(*args, **kwargs)
 
 
+def to_limit(item, extreme, xp=None):
+    if item is None:
+        return extreme
+    elif np.isscalar(item):
+        return item
+    else:
+        return to_array(item, xp=xp)
+
+
+def change(data, values, max_correction=None, out=None):
+    if max_correction is None:
+        return clip(values, out=out)
+    else:
+        return clip(values, data - max_correction, data + max_correction, out)
+
+
+def clip(data, lower=None, upper=None, out=None):
+    xp = get_array_module(data)
+    return np.clip(data, to_limit(lower, -np.inf, xp), to_limit(upper, np.inf, xp), out=out)
+
+
+def clip_softly(data, lower, upper, softening_ratio, out=None, work=None):
+    clipped = clip(data, lower, upper, out=work)
+
+    # data - clipped is negative below the lower limit, positive above the upper one and zero elsewhere
+    exceeding = np.subtract(data, clipped, out=out)
+    exceeding *= softening_ratio
+    exceeding += clipped
+
+    return exceeding
+
+
+def divide_and_clip_softly(data, divisor, lower, upper, softening_ratio, out=None, work=None):
+    if is_blocked(data):
+        out = np.empty_like(data, dtype=np.result_type(data.dtype, 1.)) if out is None else out
+        work = np.empty_like(out) if work is None else work
+        for block in blocks(data.size):
+            divide_and_clip_softly(
+                data[block], divisor, take_block(lower, block), take_block(upper, block), softening_ratio,
+                out=out[block], work=work[block]
+            )
+        return out
+
+    scaled = np.multiply(data, 1. / divisor, out=out)
+    return clip_softly(scaled, lower, upper, softening_ratio, out=scaled, work=work)
+
+
+def divide_clip_and_sum(data, divisor, lower, upper, weights=None, out=None):
+    if is_blocked(data):
+        out = np.empty_like(data, dtype=np.result_type(data.dtype, 1.)) if out is None else out
+        return sum(
+            divide_clip_and_sum(
+                data[block], divisor, take_block(lower, block), take_block(upper, block), take_block(weights, block),
+                out=out[block]
+            )
+            for block in blocks(data.size)
+        )
+
+    clipped = np.clip(np.multiply(data, 1. / divisor, out=out), lower, upper, out=out)
+    return weighted_sum(clipped, weights)
+
+
+def weighted_sum(data, weights=None):
+    # partial sums of the blocks are accumulated in double precision whatever the data type
+    if is_blocked(data):
+        return sum(weighted_sum(data[block], take_block(weights, block)) for block in blocks(data.size))
+
+    return float(data.sum() if weights is None else np.vdot(data, weights))
+
+
+def is_blocked(data):
+    # long host vectors go block by block, so that the consecutive passes run in cache instead of memory;
+    # device arrays are processed in one pass each, as every block would cost kernel launches and a sync
+    return data.ndim == 1 and data.size > _block_size and get_array_module(data) is np
+
+
+def blocks(size):
+    return (slice(start, start + _block_size) for start in range(0, size, _block_size))
+
+
+def take_block(item, block):
+    return item[block] if np.ndim(item) else item
+
+
 class ParametersSet:
-    def __init__(self, data):
-        self._data = to_array(data)
+    def __init__(self, data, dtype=None):
+        self._data = get_array_module(data).ascontiguousarray(to_array(data, dtype))
 
     @property
     def values(self):
@@ -34,88 +132,167 @@ class ParametersSet:
         else:
             raise NotImplementedError
 
-    def change(self, values, max_correction=None):
+    def change(self, values, max_correction=None, out=None):
         return ParametersSet(
-            self._reduce_changes(to_array(values), max_correction)
+            change(self._data, to_array(values, self._data.dtype, get_array_module(self._data)), max_correction, out)
         )
 
-    def _reduce_changes(self, values, max_correction):
-        return self._clip(
-            values,
-            none_or_call(max_correction, np.subtract, self._data, max_correction),
-            none_or_call(max_correction, np.add, self._data, max_correction)
+    def clip(self, lower=None, upper=None, out=None):
+        return ParametersSet(
+            clip(self._data, lower, upper, out)
         )
 
-    def clip(self, lower=None, upper=None):
+    def clip_softly(self, lower, upper, softening_ratio=1e-6):
         return ParametersSet(
-            self._clip(self._data, lower, upper)
+            clip_softly(self._data, lower, upper, softening_ratio)
         )
 
-    def clip_softly(self, lower, upper, softening_ratio=1e-6):
-        clipped = self._clip(self._data, lower, upper)
+    def __str__(self):
+        return "{name}: {data}".format(name=self.__class__.__name__, data=self._data)
 
-        negative_exceeding = np.multiply(np.subtract(self._data, lower).clip(-_big_number, 0.), softening_ratio)
-        positive_exceeding = np.multiply(np.subtract(self._data, upper).clip(0., _big_number), softening_ratio)
 
-        clipped = np.add(clipped, negative_exceeding)
-        clipped = np.add(clipped, positive_exceeding)
+class LinearVolumeCalculator:
+    def __init__(self, expected_volume, weights=None):
+        self._expected_volume = expected_volume
+        self._weights = none_or_call(weights, to_array, weights)
 
-        return ParametersSet(clipped)
+    @property
+    def expected_volume(self):
+        return self._expected_volume
 
-    def _clip(self, data, lower=None, upper=None):
-        return np.maximum(
-            self._to_limit_array(lower, -_big_number),
-            np.minimum(
-                self._to_limit_array(upper, _big_number),
-                data.copy()
-            )
-        )
+    @property
+    def weights(self):
+        return self._weights
 
-    def _to_limit_array(self, item, extreme):
-        if isinstance(item, (float, int, type(None))):
-            array = self._data.copy()
-            array.fill(extreme if item is None else item)
-            return array
+    def __call__(self, parameters):
+        if self._weights is None:
+            return parameters.sum() - self._expected_volume
         else:
-            return to_array(item)
+            weights = to_array(self._weights, xp=get_array_module(parameters))
+            return np.vdot(parameters, weights) - self._expected_volume
 
-    def __str__(self):
-        return "{name}: {data}".format(name=self.__class__.__name__, data=self._data)
+
+def create_linear_volume_calculator(expected_volume, weights=None):
+    return LinearVolumeCalculator(expected_volume, weights)
 
 
 class FullyStressDesignUpdater:
     _bounds_softening = 1e-6
     _default_bounds = (_small_number, 1 - _small_number)
+    _lambda_bracket_ratio = 2.
+    _lambda_relative_tolerance = 1e-12
+    _lambda_max_iterations = 100
 
     def __init__(self, calculate_exceeded_volume, max_correction=None, bounds=None):
         self._calculate_exceeded_volume = calculate_exceeded_volume
         self._max_correction = max_correction
-        self._bounds = bounds or self._default_bounds
+        lower, upper = bounds or self._default_bounds
+        self._bounds = to_limit(lower, -np.inf), to_limit(upper, np.inf)
+        self._last_lambda = 1.
+        self._buffers = {}
+        self._conversions = {}
+
+        # the variants of the hot path are chosen once here, not checked on every iteration
+        if max_correction is None:
+            self._reduce_changes = self._keep_changes
+        if isinstance(calculate_exceeded_volume, LinearVolumeCalculator):
+            self._create_exceeded_volume_calculator = self._create_linear_exceeded_volume_calculator
+
+    def update_parameters(self, initial, field, out=None):
+        values = initial.values
+        updated = np.abs(field, out=self._buffer('updated', values))
+        updated *= values
+        self._reduce_changes(values, updated)
+
+        updated /= self._estimate_lambda(updated)
+        return ParametersSet(np.clip(updated, *self._bounds_like(updated), out=out))
+
+    def _reduce_changes(self, values, updated):
+        lower = np.subtract(values, self._max_correction, out=self._buffer('lower', values))
+        upper = np.add(values, self._max_correction, out=self._buffer('upper', values))
+        np.clip(updated, lower, upper, out=updated)
+
+    def _keep_changes(self, values, updated):
+        pass
+
+    def _buffer(self, name, like):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != like.shape or buffer.dtype != like.dtype:
+            buffer = self._buffers[name] = np.empty_like(like)
+        return buffer
+
+    def _bounds_like(self, like):
+        return self._convert('lower', self._bounds[0], like), self._convert('upper', self._bounds[1], like)
+
+    def _convert(self, name, item, like):
+        # bounds and weights given on the host are moved once to the array module and type of the parameters
+        xp = get_array_module(like)
+        key = name, xp, like.dtype
+        if key not in self._conversions:
+            self._conversions[key] = item if item is None or np.isscalar(item) else to_array(item, like.dtype, xp)
+        return self._conversions[key]
+
+    def _estimate_lambda(self, values):
+        calc_exceeded = self._create_exceeded_volume_calculator(values)
+
+        exceeded = calc_exceeded(self._last_lambda)
+        if exceeded != 0.:
+            bracket = self._bracket_lambda(calc_exceeded, self._last_lambda, exceeded)
+
+            # brentq starts by evaluating both ends of the bracket, which are already known
+            def calc_exceeded_in_bracket(_lambda):
+                return bracket[_lambda] if _lambda in bracket else calc_exceeded(_lambda)
+
+            # lambda scales with the magnitude of the field, so the tolerance is relative to the bracket
+            self._last_lambda = scipy.optimize.brentq(
+                calc_exceeded_in_bracket,
+                min(bracket),
+                max(bracket),
+                xtol=self._lambda_relative_tolerance * min(bracket),
+                maxiter=self._lambda_max_iterations
+            )
+        return self._last_lambda
 
-    def update_parameters(self, initial, field):
-        updated = initial.change(
-            np.multiply(initial.values, np.abs(field)),
-            max_correction=self._max_correction
-        )
-        _lambda = self._estimate_lambda(updated)
-        return (
-            initial
-                .change(np.divide(updated.values, _lambda))
-                .clip(*self._bounds)
-        )
+    def _create_exceeded_volume_calculator(self, values):
+        lower, upper = self._bounds_like(values)
+        scaled = self._buffer('scaled', values)
+        clipped = self._buffer('clipped', values)
 
-    def _estimate_lambda(self, parameters):
+        # every probe passes the same scratch buffer, the volume callback must not keep a reference to it
         def calc_exceeded(_lambda):
             return self._calculate_exceeded_volume(
-                (
-                    parameters
-                        .change(np.divide(parameters.values, _lambda))
-                        .clip_softly(self._bounds[0], self._bounds[1], self._bounds_softening)
-                        .values
-
-                )
+                divide_and_clip_softly(values, _lambda, lower, upper, self._bounds_softening, out=scaled, work=clipped)
             )
-        return scipy.optimize.fsolve(calc_exceeded, 1.)[0]
+        return calc_exceeded
+
+    def _create_linear_exceeded_volume_calculator(self, values):
+        # a linear volume of softly clipped values splits into (1 - softening) * volume(clipped) + softening * volume,
+        # where the volume of unclipped values scales with 1 / lambda, so the soft clipped values are never built
+        lower, upper = self._bounds_like(values)
+        softening = self._bounds_softening
+        weights = self._convert('weights', self._calculate_exceeded_volume.weights, values)
+        expected_volume = self._calculate_exceeded_volume.expected_volume
+        volume = weighted_sum(values, weights)
+        scaled = self._buffer('scaled', values)
+
+        def calc_exceeded(_lambda):
+            clipped_volume = divide_clip_and_sum(values, _lambda, lower, upper, weights, out=scaled)
+            return (1. - softening) * clipped_volume + softening * volume / _lambda - expected_volume
+        return calc_exceeded
+
+    def _bracket_lambda(self, calc_exceeded, guess, exceeded):
+        # exceeded volume decreases with lambda, so walk away from the guess until the sign changes
+        ratio = self._lambda_bracket_ratio if exceeded > 0. else 1. / self._lambda_bracket_ratio
+        previous, previous_exceeded = guess, exceeded
+        for _ in range(self._lambda_max_iterations):
+            current = previous * ratio
+            current_exceeded = calc_exceeded(current)
+            if current_exceeded * exceeded <= 0.:
+                return {previous: previous_exceeded, current: current_exceeded}
+            previous, previous_exceeded = current, current_exceeded
+        raise ValueError(
+            "Volume constraint cannot be satisfied, lambda not bracketed between {0} and {1}".format(guess, current)
+        )
 
 
 _engines = {
@@ -134,21 +311,34 @@ class Optimizer:
         self._engine = engine
         self._calculate_strain_energy_density = calculate_strain_energy_density
         self._accuracy = accuracy
+        self._squared_accuracy = accuracy ** 2
+        self._differences = np.empty_like(parameters.values)
+        self._buffers = (
+            np.empty_like(parameters.values),
+            np.empty_like(parameters.values)
+        )
 
     def solve(self):
 
         while 1:
-            field = self._calculate_strain_energy_density(self._parameters_set.values)
-            new_parameters = self._engine.update_parameters(self._parameters_set, field)
+            # the callback may keep the parameters, e.g. as history, so it gets a copy instead of the reused buffer
+            field = self._calculate_strain_energy_density(self._parameters_set.values.copy())
+            new_parameters = self._engine.update_parameters(self._parameters_set, field, out=self._free_buffer())
             if self._check_convergence(self._parameters_set.values, new_parameters.values):
                 break
             else:
                 self._parameters_set = new_parameters
 
-        return new_parameters
+        return ParametersSet(new_parameters.values.copy())
+
+    def _free_buffer(self):
+        # the parameters are updated back and forth between two buffers, never into the current values
+        current = self._parameters_set.values
+        return self._buffers[1] if self._buffers[0] is current else self._buffers[0]
 
     def _check_convergence(self, old_parameters, new_parameters):
-        return np.linalg.norm(np.subtract(new_parameters, old_parameters)) < self._accuracy
+        differences = np.subtract(new_parameters, old_parameters, out=self._differences)
+        return np.vdot(differences, differences) < self._squared_accuracy
 
     @property
     def parameters(self):
@@ -156,9 +346,9 @@ class Optimizer:
 
 
 def create_optimizer(engine, initial, field_calculator, exceeded_volume_calculator,
-                     max_correction=None, bounds=None):
+                     max_correction=None, bounds=None, dtype=np.float64):
     return Optimizer(
-        ParametersSet(initial),
+        ParametersSet(initial, dtype),
         create_engine(engine, exceeded_volume_calculator, max_correction=max_correction, bounds=bounds),
         field_calculator
     )
@@ -1,7 +1,7 @@
 import unittest
 
 import numpy as np
-from toptim.optimizer import create_optimizer
+from toptim.optimizer import create_optimizer, create_linear_volume_calculator
 
 """
 glossary:
@@ -11,7 +11,7 @@ glossary:
 
 def create_exceeded_volume_calculator(expected_volume):
     def calc(parameters):
-        return np.sum(parameters) - expected_volume
+        return parameters.sum() - expected_volume
     return calc
 
 
@@ -52,6 +52,90 @@ class OptimizerTest(unittest.TestCase):
         self._check_result_and_constraint(np.array([0.5, 0.5]), result)
         self._check_volume_constraint(exceeded_volume_calculator, result)
 
+    def test_Solve_WeightedVolumeAndSedIsFixed_ReturnParameterForTheBiggestSedMovedToUpperBound(self):
+
+        def calculate_strain_energy_density(parameters):
+            return np.array([3., 1., 1.])
+
+        exceeded_volume_calculator = create_linear_volume_calculator(1.5, weights=[1., 0.5, 0.5])
+
+        result = self._create_and_solve(np.full((3,), 0.5), calculate_strain_energy_density, exceeded_volume_calculator)
+
+        self._check_result_and_constraint(np.array([1., 0.5, 0.5]), result)
+        self._check_volume_constraint(exceeded_volume_calculator, result)
+
+    def test_Solve_SolvedAgainAfterSedChanged_ReturnParametersForChangedSed(self):
+        sed = np.array([3., 1.])
+
+        def calculate_strain_energy_density(parameters):
+            return sed
+
+        exceeded_volume_calculator = create_exceeded_volume_calculator(1.)
+
+        o = self._create_optimizer(np.full((2,), 0.5), calculate_strain_energy_density, exceeded_volume_calculator)
+        first = o.solve()
+        sed = np.array([1., 3.])
+        second = o.solve()
+
+        self._check_result_and_constraint(np.array([1., 0.]), first)
+        self._check_result_and_constraint(np.array([0., 1.]), second)
+
+    def test_Solve_SinglePrecision_ReturnSinglePrecisionParametersMovedToCenter(self):
+
+        def calculate_strain_energy_density(parameters):
+            return np.power(parameters, -1.)
+
+        exceeded_volume_calculator = create_exceeded_volume_calculator(1.)
+
+        result = create_optimizer(
+            'fully_stress_design', [0.1, 0.9], calculate_strain_energy_density, exceeded_volume_calculator,
+            dtype=np.float32
+        ).solve()
+
+        self.assertEqual(np.float32, result.values.dtype)
+        self._check_result_and_constraint(np.array([0.5, 0.5]), result)
+        self._check_volume_constraint(exceeded_volume_calculator, result)
+
+    def test_Solve_SedOfVerySmallMagnitude_ReturnParametersSatisfyingVolumeConstraint(self):
+
+        for scale in (1e-11, 1e-14):
+            def calculate_strain_energy_density(parameters):
+                return scale*np.power(parameters, -1.)
+
+            exceeded_volume_calculator = create_exceeded_volume_calculator(1.)
+
+            result = self._create_and_solve([0.1, 0.9], calculate_strain_energy_density, exceeded_volume_calculator)
+
+            self._check_result_and_constraint(np.array([0.5, 0.5]), result)
+            self._check_volume_constraint(exceeded_volume_calculator, result)
+
+    def test_Solve_TwoDimensionalFieldAndWeightedVolume_ReturnParameterForTheBiggestSedMovedToUpperBound(self):
+
+        def calculate_strain_energy_density(parameters):
+            return np.array([[3., 1., 1.], [1., 1., 1.]])
+
+        exceeded_volume_calculator = create_linear_volume_calculator(1.5, weights=np.full((2, 3), 0.5))
+
+        result = self._create_and_solve(np.full((2, 3), 0.4), calculate_strain_energy_density, exceeded_volume_calculator)
+
+        self.assertEqual((2, 3), result.values.shape)
+        self._check_result_and_constraint(np.array([[1., 0.4, 0.4], [0.4, 0.4, 0.4]]), result)
+        self._check_volume_constraint(exceeded_volume_calculator, result)
+
+    def test_Solve_SedCalculatorKeepsParameters_KeptParametersNotOverwritten(self):
+        history = []
+
+        def calculate_strain_energy_density(parameters):
+            history.append(parameters)
+            return np.power(parameters, -1.)
+
+        exceeded_volume_calculator = create_exceeded_volume_calculator(1.)
+
+        self._create_and_solve([0.1, 0.9], calculate_strain_energy_density, exceeded_volume_calculator)
+
+        np.testing.assert_allclose(np.array([0.1, 0.9]), history[0])
+        self.assertEqual(len(history), len(set(id(parameters) for parameters in history)))
+
     def _check_result_and_constraint(self, expected_result, output):
         np.testing.assert_allclose(
             expected_result,
@@ -1,7 +1,11 @@
+import types
 import unittest
+import warnings
+from unittest import mock
 
 import numpy as np
-from toptim.optimizer import ParametersSet, create_engine
+from toptim import optimizer
+from toptim.optimizer import ParametersSet, create_engine, create_linear_volume_calculator, divide_and_clip_softly
 
 
 class ParametersSetTest(unittest.TestCase):
@@ -14,6 +18,23 @@ class ParametersSetTest(unittest.TestCase):
         self.assertTrue(isinstance(_set.values, np.ndarray))
         np.testing.assert_array_equal(np.array(data), _set.values)
 
+    def test_Create_IntegerDataProvided_StoreValuesAsContiguousFloatArray(self):
+
+        data = np.arange(6)[::2]
+
+        _set = self._create_set(data)
+
+        self.assertEqual(np.float64, _set.values.dtype)
+        self.assertTrue(_set.values.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(np.array([0., 2., 4.]), _set.values)
+
+    def test_Create_SinglePrecisionDataProvided_KeepDataType(self):
+
+        _set = self._create_set(np.array([1., 2.], dtype=np.float32))
+
+        self.assertEqual(np.float32, _set.values.dtype)
+        self.assertEqual(np.float32, _set.change([0.5, 1.5]).values.dtype)
+
     def test_Change_Always_ReturnCloneWithChangedData(self):
 
         _set = self._create_set([1.0])
@@ -43,6 +64,17 @@ class ParametersSetTest(unittest.TestCase):
         self._check_if_clone(_set, result)
         self._check_result([0.5, 0.5, 2., 2.5], result)
 
+    def test_Clip_SinglePrecisionAndOnlyUpperLimit_ReturnCloneDataBelowLimit(self):
+        _set = self._create_set(np.array([0., -1., 2., 3.], dtype=np.float32))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            result = _set.clip(upper=1.5)
+
+        self._check_if_clone(_set, result)
+        self.assertEqual(np.float32, result.values.dtype)
+        self._check_result([0., -1., 1.5, 1.5], result)
+
     def test_Clip_ArrayLimit_ReturnCloneDataWithinIndividualLimits(self):
         _set = self._create_set([0., -1., 2., 3.])
 
@@ -103,6 +135,149 @@ class ParametersSetTest(unittest.TestCase):
         return ParametersSet(data, **kwargs)
 
 
+class DivideAndClipSoftlyTest(unittest.TestCase):
+    def test_Call_BuffersProvided_WriteDividedAndSoftlyClippedDataToOutput(self):
+        softening = 1e-2
+        data = np.array([0., -2., 4., 6.])
+        out = np.empty_like(data)
+
+        result = divide_and_clip_softly(data, 2., 0.5, 2.5, softening, out=out, work=np.empty_like(data))
+
+        self.assertIs(out, result)
+        np.testing.assert_allclose(
+            np.array([0.5 - softening*0.5, 0.5 - softening*1.5, 2., 2.5 + softening*0.5]),
+            result
+        )
+        np.testing.assert_array_equal(np.array([0., -2., 4., 6.]), data)
+
+    def test_Call_LongDataAndIndividualLimits_ReturnSameValuesAsElementwiseCalculation(self):
+        softening = 1e-2
+        size = 200003
+        data = np.linspace(-1., 3., size)
+        lower = np.full((size, ), 0.5)
+        upper = np.linspace(1., 2., size)
+
+        result = divide_and_clip_softly(data, 2., lower, upper, softening)
+
+        scaled = data / 2.
+        clipped = np.clip(scaled, lower, upper)
+        np.testing.assert_allclose(clipped + (scaled - clipped)*softening, result)
+
+
+class LinearVolumeCalculatorTest(unittest.TestCase):
+    def test_Call_NoWeights_ReturnSumOfParametersMinusExpectedVolume(self):
+        calculator = create_linear_volume_calculator(1.)
+
+        self.assertAlmostEqual(0.5, calculator(np.array([0.5, 0.25, 0.75])))
+
+    def test_Call_Weights_ReturnWeightedSumOfParametersMinusExpectedVolume(self):
+        calculator = create_linear_volume_calculator(1., weights=[2., 1., 0.5])
+
+        self.assertAlmostEqual(0.625, calculator(np.array([0.5, 0.25, 0.75])))
+
+    def test_Call_MultidimensionalParametersAndWeights_ReturnScalarWeightedSumMinusExpectedVolume(self):
+        calculator = create_linear_volume_calculator(1., weights=np.full((2, 3), 2.))
+
+        self.assertAlmostEqual(5., calculator(np.full((2, 3), 0.5)))
+
+
+class DeviceArray(np.ndarray):
+    # stands for a GPU array, which like a cupy one refuses to be mixed with host arrays
+
+    def __array_ufunc__(self, ufunc, method, *inputs, out=(), **kwargs):
+        if any(type(item) is np.ndarray for item in inputs + out):
+            raise TypeError('device and host arrays mixed in {0}'.format(ufunc.__name__))
+        if out:
+            kwargs['out'] = tuple(item.view(np.ndarray) for item in out)
+        result = getattr(ufunc, method)(*(to_host(item) for item in inputs), **kwargs)
+        return result.view(DeviceArray) if isinstance(result, np.ndarray) else result
+
+
+def to_host(item):
+    return item.view(np.ndarray) if isinstance(item, DeviceArray) else item
+
+
+def to_device(item, dtype=None):
+    return np.asarray(item, dtype=dtype).view(DeviceArray)
+
+
+class DeviceModule:
+    def __init__(self):
+        self.converted = []
+
+    def asarray(self, item, dtype=None):
+        self.converted.append(item)
+        return to_device(item, dtype)
+
+    def ascontiguousarray(self, item):
+        return to_device(np.ascontiguousarray(to_host(item)))
+
+
+class ArrayModuleTest(unittest.TestCase):
+    def setUp(self):
+        self._device = DeviceModule()
+        fake_cupy = types.SimpleNamespace(
+            get_array_module=lambda item: self._device if isinstance(item, DeviceArray) else np
+        )
+        patcher = mock.patch.object(optimizer, 'cupy', fake_cupy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_GetArrayModule_NoCupy_ReturnNumpy(self):
+        with mock.patch.object(optimizer, 'cupy', None):
+            self.assertIs(np, optimizer.get_array_module(to_device([1., 2.])))
+
+    def test_GetArrayModule_DeviceArray_ReturnDeviceModule(self):
+        self.assertIs(self._device, optimizer.get_array_module(to_device([1., 2.])))
+        self.assertIs(np, optimizer.get_array_module(np.array([1., 2.])))
+
+    def test_Create_DeviceData_KeepDataOnDevice(self):
+        _set = ParametersSet(to_device([1., 2.]))
+
+        self.assertIsInstance(_set.values, DeviceArray)
+
+    def test_Update_DeviceParametersAndHostBoundsAndWeights_ConvertBoundsAndWeightsToDevice(self):
+        parameters = ParametersSet(to_device([0.1, 0.2, 0.2]))
+        field = to_device([30., 0.2, 0.0])
+        calculator = create_linear_volume_calculator(0.6, [1., 0.5, 0.5])
+
+        engine = create_engine('fully_stress_design', calculator, bounds=([0.1, 0.1, 0.1], [0.9, 0.9, 0.9]))
+
+        updated = engine.update_parameters(parameters, field)
+
+        self.assertIsInstance(updated.values, DeviceArray)
+        self.assertTrue(any(converted is calculator.weights for converted in self._device.converted))
+        np.testing.assert_allclose(np.array([0.5, 0.1, 0.1]), to_host(updated.values), atol=1e-2)
+
+    def test_DivideAndClipSoftly_LongDeviceData_ProcessWithoutBlocks(self):
+        size = 200003
+        data = to_device(np.linspace(-1., 3., size))
+
+        with mock.patch.object(optimizer, 'blocks') as blocks:
+            result = divide_and_clip_softly(data, 2., 0.5, 1.5, 1e-2)
+
+        blocks.assert_not_called()
+        self.assertIsInstance(result, DeviceArray)
+        self.assertEqual((size, ), result.shape)
+
+
+@unittest.skipIf(optimizer.cupy is None, 'cupy is not installed')
+class CupyTest(unittest.TestCase):
+    def test_Solve_CupyParametersAndHostBoundsAndWeights_ReturnParametersOnDevice(self):
+        cupy = optimizer.cupy
+
+        def calculate_strain_energy_density(parameters):
+            return cupy.asarray([3., 1., 1.])
+
+        result = optimizer.create_optimizer(
+            'fully_stress_design', cupy.full((3,), 0.5), calculate_strain_energy_density,
+            create_linear_volume_calculator(1.5, weights=[1., 0.5, 0.5]), bounds=([1e-3]*3, [1.]*3)
+        ).solve()
+
+        self.assertIs(cupy, cupy.get_array_module(result.values))
+        np.testing.assert_allclose(np.array([1., 0.5, 0.5]), cupy.asnumpy(result.values), atol=1e-2)
+
+
 class FullyStressDesignEngineTest(unittest.TestCase):
     def test_Update_ParametersWithinLimits_ReturnValuesMultipliedByAbsStrains(self):
 
@@ -120,6 +295,23 @@ class FullyStressDesignEngineTest(unittest.TestCase):
             np.multiply(parameters.values, field),
             updated.values)
 
+    def test_Update_OutputProvided_WriteUpdatedParametersToOutput(self):
+
+        parameters = ParametersSet([0.1, 0.2])
+        field = np.array([0.3, 0.4])
+        out = np.empty((2, ))
+
+        def constraint_calculator(*args):
+            return 0.
+
+        engine = self._create_engine(constraint_calculator)
+
+        updated = engine.update_parameters(parameters, field, out=out)
+
+        self.assertIs(out, updated.values)
+        np.testing.assert_allclose(np.array([0.03, 0.08]), out)
+        np.testing.assert_array_equal(np.array([0.1, 0.2]), parameters.values)
+
     def test_Update_ParametersViolateGlobalLimits_ReturnUpdatedParametersWithinGlobalBoundsWithTolerance(self):
 
         _min, _max = 1e-6, 1. - 1e-6
@@ -174,6 +366,36 @@ class FullyStressDesignEngineTest(unittest.TestCase):
         self.assertTrue(np.all(updated.values >= min_bound))
         self.assertTrue(np.all(updated.values <= max_bound))
 
+    def test_Update_LinearVolumeCalculator_ReturnSameParametersAsGenericCalculator(self):
+        size = 100003
+        parameters = ParametersSet(np.linspace(0.1, 0.9, size))
+        field = np.linspace(3., 0.1, size)
+        weights = np.linspace(0.5, 1.5, size)
+        expected_volume = 0.4*size
+
+        def constraint_calculator(values):
+            return np.dot(values, weights) - expected_volume
+
+        generic = self._create_engine(constraint_calculator).update_parameters(parameters, field)
+        linear = self._create_engine(
+            create_linear_volume_calculator(expected_volume, weights)
+        ).update_parameters(parameters, field)
+
+        np.testing.assert_allclose(generic.values, linear.values)
+
+    def test_Update_ConstraintCannotBeSatisfied_Raise(self):
+
+        parameters = ParametersSet([0.1, 0.2])
+        field = np.array([0.3, 0.4])
+
+        def constraint_calculator(*args):
+            return 1.
+
+        engine = self._create_engine(constraint_calculator)
+
+        with self.assertRaises(ValueError):
+            engine.update_parameters(parameters, field)
+
     def _create_engine(self, calculate_exceeded_volume, **kwargs):
         return create_engine('fully_stress_design', calculate_exceeded_volume, **kwargs)
 